@@ -2,14 +2,18 @@
 # Single-file Restoration Lead Pipeline + Analytics + Internal ML + Phase 2 UX
 # Run: streamlit run project_x_restoration_full_v2.py
 
+import logging
 import os
 import time
 import threading
-import traceback
+import uuid
 from datetime import datetime, timedelta, date
 
 import streamlit as st
 import pandas as pd
+import numpy as np
+
+log = logging.getLogger(__name__)
 
 # optional plotting
 try:
@@ -35,7 +39,7 @@ except Exception:
     SKLEARN_AVAILABLE = False
 
 # SQLAlchemy
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Text, inspect, text
+from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Text, inspect, text, func, select, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -49,8 +53,38 @@ UPLOAD_FOLDER = os.path.join(os.getcwd(), "uploads_v2")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+
+# cache_size is negative -> KiB, i.e. a 64 MiB page cache per connection
+SQLITE_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "mmap_size=268435456", "cache_size=-65536")
+
+def _set_sqlite_pragmas(dbapi_conn, _connection_record):
+    # WAL lets the dashboard keep reading while Lead Capture / the ML worker write;
+    # synchronous=NORMAL is durable enough under WAL and skips an fsync per commit
+    cur = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cur.execute(f"PRAGMA {pragma}")
+    cur.close()
+
+# Streamlit re-executes this script on every interaction; caching keeps one
+# engine (and its connection pool) per process instead of one per rerun.
+@st.cache_resource(show_spinner=False)
+def get_engine():
+    # one pool shared by every browser session plus the SLA / ML daemon threads;
+    # LIFO hands out the most recently used (warm page cache, live mmap) connection first
+    eng = create_engine(
+        DATABASE_URL, connect_args={"check_same_thread": False},
+        pool_size=10, max_overflow=10, pool_timeout=30, pool_recycle=3600,
+        pool_pre_ping=True, pool_use_lifo=True,
+    )
+    event.listen(eng, "connect", _set_sqlite_pragmas)
+    return eng
+
+@st.cache_resource(show_spinner=False)
+def get_session_factory():
+    return sessionmaker(bind=get_engine())
+
+engine = get_engine()
+SessionLocal = get_session_factory()
 
 # ---------------------------
 # Lead statuses and colors
@@ -75,6 +109,15 @@ STAGE_COLORS = {
     LeadStatus.LOST: "#EF4444",
 }
 
+# the fixed pipeline order as a categorical; statuses outside it get code -1
+STATUS_DTYPE = pd.CategoricalDtype(LeadStatus.ALL)
+
+def stage_counts(status):
+    # leads per stage in LeadStatus.ALL order via one bincount over the category codes
+    # (unknown statuses, code -1, are dropped like the old value_counts().reindex)
+    codes = status.astype(STATUS_DTYPE).cat.codes.to_numpy()
+    return pd.Series(np.bincount(codes[codes >= 0], minlength=len(LeadStatus.ALL)), index=LeadStatus.ALL)
+
 # ---------------------------
 # ORM Model
 # ---------------------------
@@ -91,10 +134,16 @@ class Lead(Base):
     assigned_to = Column(String, nullable=True)
     notes = Column(Text, nullable=True)
     estimated_value = Column(Float, nullable=True)
-    status = Column(String, default=LeadStatus.NEW)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    status = Column(String, default=LeadStatus.NEW, index=True)
+    # SQLite stamps CURRENT_TIMESTAMP (UTC) itself; tables created before this keep no
+    # column default, so the insert sites still pass created_at explicitly
+    created_at = Column(DateTime, server_default=func.now(), index=True)
     sla_hours = Column(Integer, default=24)
-    sla_entered_at = Column(DateTime, nullable=True)
+    # no default: a raw or imported row without it falls back to created_at on every read
+    sla_entered_at = Column(DateTime, nullable=True, index=True)
+    # sla_entered_at (or created_at) + sla_hours, stored so overdue checks are one indexed comparison;
+    # kept current by the leads_sla_deadline_* triggers (see init_db), so writers never set it
+    sla_deadline = Column(DateTime, nullable=True, index=True)
     contacted = Column(Boolean, default=False)
     inspection_scheduled = Column(Boolean, default=False)
     inspection_completed = Column(Boolean, default=False)
@@ -113,11 +162,21 @@ class Lead(Base):
 # ---------------------------
 # DB init + migration safety
 # ---------------------------
+# SQL twin of sla_deadline_for, evaluated against the leads row
+SLA_DEADLINE_SQL = (
+    "strftime('%Y-%m-%d %H:%M:%f', COALESCE(sla_entered_at, created_at), "
+    "'+' || COALESCE(NULLIF(sla_hours, 0), 24) || ' hours')"
+)
+
+# migrations run once per process, not on every rerun of every session; a failure is not
+# cached, so the next rerun retries
+@st.cache_resource(show_spinner=False)
 def init_db():
     Base.metadata.create_all(bind=engine)
     insp = inspect(engine)
     cols = [c["name"] for c in insp.get_columns("leads")]
-    with engine.connect() as conn:
+    # begin() commits on exit; a plain connect() would roll the DDL back on close
+    with engine.begin() as conn:
         def try_add(col_sql):
             try:
                 conn.execute(text(col_sql))
@@ -129,11 +188,30 @@ def init_db():
             "predicted_prob": "ALTER TABLE leads ADD COLUMN predicted_prob FLOAT;",
             "awarded_invoice": "ALTER TABLE leads ADD COLUMN awarded_invoice TEXT;",
             "estimate_approved": "ALTER TABLE leads ADD COLUMN estimate_approved FLOAT;",
-            "sla_entered_at": "ALTER TABLE leads ADD COLUMN sla_entered_at TEXT;"
+            "sla_entered_at": "ALTER TABLE leads ADD COLUMN sla_entered_at TEXT;",
+            "sla_deadline": "ALTER TABLE leads ADD COLUMN sla_deadline TEXT;"
         }
         for col, sql in additions.items():
             if col not in cols:
                 try_add(sql)
+        # create_all does not add indexes to an existing table
+        for col in ("status", "created_at", "sla_entered_at", "sla_deadline"):
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_leads_{col} ON leads ({col})"))
+        # serves "recent leads in a status" and the open-lead scans in one index walk
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_leads_status_created ON leads (status, created_at DESC)"))
+        # fill deadlines for rows written before the column existed; a no-op once every row has one
+        conn.execute(text(f"UPDATE leads SET sla_deadline = {SLA_DEADLINE_SQL} WHERE sla_deadline IS NULL"))
+        # every later insert (ORM or raw SQL) gets its deadline in the same statement's transaction
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS leads_sla_deadline_ins AFTER INSERT ON leads "
+            f"WHEN NEW.sla_deadline IS NULL BEGIN UPDATE leads SET sla_deadline = {SLA_DEADLINE_SQL} "
+            "WHERE id = NEW.id; END"
+        ))
+        # and follows the row when its SLA start or length changes (recursive triggers are off)
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS leads_sla_deadline_upd AFTER UPDATE OF sla_entered_at, sla_hours ON leads "
+            f"BEGIN UPDATE leads SET sla_deadline = {SLA_DEADLINE_SQL} WHERE id = NEW.id; END"
+        ))
 
 init_db()
 
@@ -143,132 +221,213 @@ init_db()
 def get_session():
     return SessionLocal()
 
-def save_uploaded_file(uploaded_file, prefix="file"):
+def upload_path(uploaded_file, prefix="file"):
+    # a random token instead of the second-resolution timestamp: re-uploads within a second no longer collide
+    return os.path.join(UPLOAD_FOLDER, f"{prefix}_{uuid.uuid4().hex[:8]}_{uploaded_file.name}")
+
+def save_uploaded_file(uploaded_file, prefix="file", path=None):
     if uploaded_file is None:
         return None
-    fname = f"{prefix}_{int(datetime.utcnow().timestamp())}_{uploaded_file.name}"
-    path = os.path.join(UPLOAD_FOLDER, fname)
+    path = path or upload_path(uploaded_file, prefix)
     with open(path, "wb") as f:
+        # UploadedFile is already in memory; getbuffer() is a zero-copy view of it
         f.write(uploaded_file.getbuffer())
     return path
 
 # ---------------------------
 # SLA calculation
 # ---------------------------
-def calculate_remaining_sla(sla_entered_at, sla_hours):
-    try:
-        if sla_entered_at is None:
-            sla_entered_at = datetime.utcnow()
-        if isinstance(sla_entered_at, str):
-            sla_entered_at = datetime.fromisoformat(sla_entered_at)
-        deadline = sla_entered_at + timedelta(hours=int(sla_hours or 24))
-        remain = deadline - datetime.utcnow()
-        return max(remain.total_seconds(), 0.0), (remain.total_seconds() <= 0)
-    except Exception:
-        return 0.0, False
+def sla_deadline_for(sla_entered_at, sla_hours):
+    # what the init_db triggers store in Lead.sla_deadline; missing/zero hours mean 24, the
+    # same rule as compute_priority_vectorized
+    return sla_entered_at + timedelta(hours=int(sla_hours or 24))
 
 # ---------------------------
 # Build pandas DataFrame from DB, with date filtering default TODAY
 # ---------------------------
-def leads_df(session, start_date: date = None, end_date: date = None):
-    rows = session.query(Lead).order_by(Lead.created_at.desc()).all()
-    data = []
-    for r in rows:
-        data.append({
-            "id": r.id,
-            "source": r.source,
-            "source_details": r.source_details,
-            "contact_name": r.contact_name,
-            "contact_phone": r.contact_phone,
-            "contact_email": r.contact_email,
-            "property_address": r.property_address,
-            "damage_type": r.damage_type,
-            "assigned_to": r.assigned_to,
-            "notes": r.notes,
-            "estimated_value": float(r.estimated_value or 0.0),
-            "status": r.status,
-            "created_at": r.created_at,
-            "sla_hours": r.sla_hours,
-            "sla_entered_at": r.sla_entered_at or r.created_at,
-            "contacted": bool(r.contacted),
-            "inspection_scheduled": bool(r.inspection_scheduled),
-            "inspection_completed": bool(r.inspection_completed),
-            "inspection_scheduled_at": r.inspection_scheduled_at,
-            "estimate_submitted": bool(r.estimate_submitted),
-            "estimate_approved": bool(getattr(r, "estimate_approved", False)),
-            "awarded_date": r.awarded_date,
-            "awarded_invoice": getattr(r, "awarded_invoice", None),
-            "lost_date": r.lost_date,
-            "qualified": bool(r.qualified),
-            "cost_to_acquire": float(r.cost_to_acquire or 0.0),
-            "predicted_prob": float(r.predicted_prob) if r.predicted_prob is not None else None
-        })
-    df = pd.DataFrame(data)
-    if df.empty:
-        # return an empty df with columns
-        df = pd.DataFrame(columns=[
-            "id","source","source_details","contact_name","contact_phone","contact_email",
-            "property_address","damage_type","assigned_to","notes","estimated_value","status",
-            "created_at","sla_hours","sla_entered_at","contacted","inspection_scheduled","inspection_scheduled_at",
-            "inspection_completed","estimate_submitted","estimate_approved","awarded_date","awarded_invoice","lost_date","qualified",
-            "cost_to_acquire","predicted_prob"
-        ])
-        return df
+LEAD_COLUMNS = [
+    "id", "source", "source_details", "contact_name", "contact_phone", "contact_email",
+    "property_address", "damage_type", "assigned_to", "notes", "estimated_value", "status",
+    "created_at", "sla_hours", "sla_entered_at", "contacted", "inspection_scheduled",
+    "inspection_completed", "inspection_scheduled_at", "estimate_submitted", "estimate_approved",
+    "awarded_date", "awarded_invoice", "lost_date", "qualified", "cost_to_acquire", "predicted_prob",
+    "sla_deadline",
+]
+LEAD_DATE_COLUMNS = ["created_at", "sla_entered_at", "inspection_scheduled_at", "awarded_date", "lost_date", "sla_deadline"]
+LEAD_BOOL_COLUMNS = ["contacted", "inspection_scheduled", "inspection_completed", "estimate_submitted", "estimate_approved", "qualified"]
+# low-cardinality text columns; category codes make filters and value_counts integer work.
+# status keeps whatever string is stored (not STATUS_DTYPE, which would blank unknown ones)
+LEAD_CATEGORY_COLUMNS = ["source", "damage_type", "assigned_to", "status"]
+# applied by read_sql_query itself; flags stay nullable here and are filled after the read
+LEAD_DTYPES = {
+    "estimated_value": "float64", "cost_to_acquire": "float64", "predicted_prob": "float64",
+    **{c: "boolean" for c in LEAD_BOOL_COLUMNS},
+    **{c: "category" for c in LEAD_CATEGORY_COLUMNS},
+}
+
+def _created_bounds(start_date: date = None, end_date: date = None):
+    # half-open [start, end + 1 day) window; None means "no date filter"
     # default to TODAY if no range specified
     if start_date is None and end_date is None:
         today = datetime.utcnow().date()
         start_date = today
         end_date = today
-    if start_date is not None and end_date is not None:
-        sdt = datetime.combine(start_date, datetime.min.time())
-        edt = datetime.combine(end_date, datetime.max.time())
-        df = df[(df["created_at"] >= sdt) & (df["created_at"] <= edt)].copy()
+    if start_date is None or end_date is None:
+        return None
+    return pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1)
+
+def _build_leads_frame(session, bounds=None):
+    # single bulk read straight into columns; no ORM instances or per-row dicts
+    cols = [
+        func.coalesce(Lead.sla_entered_at, Lead.created_at).label(c) if c == "sla_entered_at" else getattr(Lead, c)
+        for c in LEAD_COLUMNS
+    ]
+    stmt = select(*cols).order_by(Lead.created_at.desc())
+    if bounds is not None:
+        stmt = stmt.where(Lead.created_at >= bounds[0].to_pydatetime(), Lead.created_at < bounds[1].to_pydatetime())
+    # parse_dates keeps every timestamp column datetime64 even when it is entirely NULL
+    df = pd.read_sql_query(stmt, session.connection(), parse_dates=LEAD_DATE_COLUMNS, dtype=LEAD_DTYPES)
+    df[["estimated_value", "cost_to_acquire"]] = df[["estimated_value", "cost_to_acquire"]].fillna(0.0)
+    df[LEAD_BOOL_COLUMNS] = df[LEAD_BOOL_COLUMNS].fillna(False).astype(bool)
+    # an empty result still carries every LEAD_COLUMNS column with its dtype
     return df
 
+def filter_created_range(df, start_date: date = None, end_date: date = None):
+    bounds = _created_bounds(start_date, end_date)
+    if df.empty or bounds is None:
+        return df
+    return df[df["created_at"].between(bounds[0], bounds[1], inclusive="left")].copy()
+
+def leads_df(session, start_date: date = None, end_date: date = None):
+    # uncached path (background workers): let SQLite apply the date window
+    return _build_leads_frame(session, _created_bounds(start_date, end_date))
+
 # ---------------------------
-# Priority scoring function (used for Top 5)
+# Cached DataFrame for the UI (reused across reruns until the data changes)
 # ---------------------------
-def compute_priority_for_lead_row(lead_row, weights=None):
-    if weights is None:
-        weights = {
-            "value_weight": 0.5, "sla_weight": 0.35, "urgency_weight": 0.15,
-            "contacted_w": 0.6, "inspection_w": 0.5, "estimate_w": 0.5, "value_baseline": 5000.0
-        }
-    try:
-        val = float(lead_row.get("estimated_value") or 0.0)
-        baseline = float(weights.get("value_baseline", 5000.0))
-        value_score = min(1.0, val / max(1.0, baseline))
-    except Exception:
-        value_score = 0.0
+def leads_db_version():
+    # cheap aggregate (indexed columns) that changes whenever a lead is inserted;
+    # in-place edits (lead Save, model retrain) call invalidate_leads_cache() explicitly
+    with engine.connect() as conn:
+        return tuple(conn.execute(text(
+            "SELECT COUNT(*), MAX(id), MAX(created_at), MAX(sla_entered_at) FROM leads"
+        )).one())
 
-    try:
-        sla_entered = lead_row.get("sla_entered_at") or lead_row.get("created_at")
-        if isinstance(sla_entered, str):
-            sla_entered = datetime.fromisoformat(sla_entered)
-        deadline = sla_entered + timedelta(hours=int(lead_row.get("sla_hours") or 24))
-        time_left_h = max((deadline - datetime.utcnow()).total_seconds() / 3600.0, 0.0)
-    except Exception:
-        time_left_h = 9999.0
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_leads_frame(db_version):
+    with get_session() as s:
+        return _build_leads_frame(s)
 
-    sla_score = max(0.0, (72.0 - min(time_left_h, 72.0)) / 72.0)
-    contacted_flag = 0.0 if bool(lead_row.get("contacted")) else 1.0
-    inspection_flag = 0.0 if bool(lead_row.get("inspection_scheduled")) else 1.0
-    estimate_flag = 0.0 if bool(lead_row.get("estimate_submitted")) else 1.0
+def cached_leads_df(start_date: date = None, end_date: date = None):
+    return filter_created_range(_cached_leads_frame(leads_db_version()), start_date, end_date)
 
-    urgency_component = (contacted_flag * weights.get("contacted_w", 0.6) +
-                        inspection_flag * weights.get("inspection_w", 0.5) +
-                        estimate_flag * weights.get("estimate_w", 0.5))
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_leads_csv(db_version, start_date, end_date):
+    return filter_created_range(_cached_leads_frame(db_version), start_date, end_date).to_csv(index=False).encode("utf-8")
 
-    total_weight = (weights.get("value_weight", 0.5) +
-                    weights.get("sla_weight", 0.35) +
-                    weights.get("urgency_weight", 0.15))
+def cached_leads_csv(start_date: date = None, end_date: date = None):
+    # the Exports page re-renders the download button every run; serialise once per data version
+    return _cached_leads_csv(leads_db_version(), start_date, end_date)
+
+def invalidate_leads_cache():
+    _cached_leads_frame.clear()
+    _cached_leads_csv.clear()
+    _cached_top_priority.clear()
+
+# ---------------------------
+# Priority scoring (used for Top 5), vectorized over the whole DataFrame
+# ---------------------------
+DEFAULT_PRIORITY_WEIGHTS = {
+    "value_weight": 0.5, "sla_weight": 0.35, "urgency_weight": 0.15,
+    "contacted_w": 0.6, "inspection_w": 0.5, "estimate_w": 0.5, "value_baseline": 5000.0
+}
+
+# score buckets: [0, 0.45) normal, [0.45, 0.7) high, [0.7, 1] critical
+PRIORITY_THRESHOLDS = [0.45, 0.7]
+PRIORITY_BUCKETS = [("#22c55e", "🟢 NORMAL"), ("#f97316", "🟠 HIGH"), ("#ef4444", "🔴 CRITICAL")]
+# the label markup only depends on the bucket, so it is rendered once here
+PRIORITY_LABEL_HTML = np.array([f"<b style='color:{color};'>{label}</b>" for color, label in PRIORITY_BUCKETS])
+OVERDUE_BADGE_HTML = "<span style='color:#ef4444;'> ❗OVERDUE</span>"
+
+def priority_label_html(scores):
+    return PRIORITY_LABEL_HTML[np.digitize(np.asarray(scores, dtype=float), PRIORITY_THRESHOLDS)]
+
+def top_k_positions(values, k):
+    # positions of the k largest values, best first: O(N) argpartition finds the k-th value,
+    # then ties at that boundary are taken in row order, like nlargest(keep="first")
+    values = np.asarray(values, dtype=float)
+    if len(values) <= k:
+        idx = np.arange(len(values))
+    else:
+        kth = values[np.argpartition(-values, k - 1)[k - 1]]
+        above = np.flatnonzero(values > kth)
+        idx = np.sort(np.concatenate([above, np.flatnonzero(values == kth)[:k - len(above)]]))
+    return idx[np.argsort(-values[idx], kind="stable")]
+
+def _priority_kernel(value, sla_hours, sla_start_s, contacted, inspection_scheduled, estimate_submitted, now_s, w):
+    # fused scoring over plain ndarrays (no index alignment, no intermediate Series)
+    value_score = np.minimum(value / max(1.0, float(w["value_baseline"])), 1.0)
+    remaining_h = (sla_start_s + sla_hours * 3600.0 - now_s) / 3600.0
+    # unparseable SLA start -> treated as far from due, like the old per-row fallback
+    time_left_h = np.where(np.isnan(remaining_h), 9999.0, np.maximum(remaining_h, 0.0))
+    sla_score = (72.0 - np.minimum(time_left_h, 72.0)) / 72.0
+    urgency_component = (~contacted * w["contacted_w"] +
+                         ~inspection_scheduled * w["inspection_w"] +
+                         ~estimate_submitted * w["estimate_w"])
+
+    total_weight = w["value_weight"] + w["sla_weight"] + w["urgency_weight"]
     if total_weight <= 0:
         total_weight = 1.0
 
-    score = (value_score * weights.get("value_weight", 0.5) +
-             sla_score * weights.get("sla_weight", 0.35) +
-             urgency_component * weights.get("urgency_weight", 0.15)) / total_weight
-    return max(0.0, min(score, 1.0))
+    score = (value_score * w["value_weight"] +
+             sla_score * w["sla_weight"] +
+             urgency_component * w["urgency_weight"]) / total_weight
+    return np.clip(score, 0.0, 1.0), time_left_h, remaining_h <= 0
+
+def compute_priority_vectorized(df, weights=None, now=None):
+    # returns priority_score / time_left_hours / sla_deadline / overdue columns aligned
+    # with df.index; `now` is a naive UTC datetime, like the stored timestamps
+    now_s = time.time() if now is None else pd.Timestamp(now).value / 1e9
+    w = dict(DEFAULT_PRIORITY_WEIGHTS)
+    w.update(weights or {})
+
+    value = pd.to_numeric(df["estimated_value"], errors="coerce").fillna(0.0).to_numpy(dtype=float)
+    sla_hours = np.trunc(pd.to_numeric(df["sla_hours"], errors="coerce").fillna(0).to_numpy(dtype=float))
+    sla_hours[sla_hours == 0] = 24.0
+    sla_entered = pd.to_datetime(df["sla_entered_at"].fillna(df["created_at"]), errors="coerce")
+    sla_start_s = np.where(
+        sla_entered.isna().to_numpy(),
+        np.nan,
+        sla_entered.to_numpy(dtype="datetime64[ns]").astype("int64") / 1e9,
+    )
+    score, time_left_h, overdue = _priority_kernel(
+        value, sla_hours, sla_start_s,
+        df["contacted"].to_numpy(dtype=bool),
+        df["inspection_scheduled"].to_numpy(dtype=bool),
+        df["estimate_submitted"].to_numpy(dtype=bool),
+        now_s, w,
+    )
+    return pd.DataFrame({
+        "priority_score": score,
+        "time_left_hours": time_left_h,
+        "sla_deadline": sla_entered + pd.to_timedelta(sla_hours, unit="h"),
+        "overdue": overdue,
+    }, index=df.index)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_top_priority(db_version, start_date, end_date, weights_items, k):
+    # reruns that don't touch the data, range or weights reuse the winners;
+    # time left / overdue are therefore up to a ttl behind the clock
+    df = filter_created_range(_cached_leads_frame(db_version), start_date, end_date)
+    if df.empty:
+        return df
+    # pick the winners on the raw score array and only materialise those rows
+    scores = compute_priority_vectorized(df, dict(weights_items))
+    pos = top_k_positions(scores["priority_score"].to_numpy(), k)
+    return df[["id", "contact_name", "estimated_value", "predicted_prob"]].iloc[pos].join(scores.iloc[pos])
+
+def cached_top_priority(start_date=None, end_date=None, weights=None, k=5):
+    return _cached_top_priority(leads_db_version(), start_date, end_date, tuple(sorted((weights or {}).items())), k)
 
 # ---------------------------
 # ML pipeline & internal autorun
@@ -295,19 +454,18 @@ def auto_train_model(session):
     if not SKLEARN_OK:
         return None
     try:
-        df = leads_df(session)
-        if df.empty:
-            return None
-        labeled = df[df["status"].isin([LeadStatus.AWARDED, LeadStatus.LOST])]
-        if len(labeled) < ML_MIN_LABELS:
+        # check the label count in SQL before loading the whole frame
+        counts = lead_status_counts(session)
+        if counts.get(LeadStatus.AWARDED, 0) + counts.get(LeadStatus.LOST, 0) < ML_MIN_LABELS:
             return None
+        df = leads_df(session)
         pipeline_tuple = build_ml_pipeline()
         if pipeline_tuple is None:
             return None
         pipeline, numeric_cols, categorical_cols = pipeline_tuple
         X = df[numeric_cols + categorical_cols].copy()
         X[numeric_cols] = X[numeric_cols].fillna(0.0)
-        X[categorical_cols] = X[categorical_cols].fillna("unknown").astype(str)
+        X[categorical_cols] = X[categorical_cols].astype(object).fillna("unknown").astype(str)
         y = (df["status"] == LeadStatus.AWARDED).astype(int)
         stratify = y if y.nunique() > 1 else None
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=stratify)
@@ -319,12 +477,13 @@ def auto_train_model(session):
         # update preds
         try:
             probs = pipeline.predict_proba(X)[:, 1]
-            for lid, p in zip(df["id"], probs):
-                lead = session.query(Lead).filter(Lead.id == int(lid)).first()
-                if lead:
-                    lead.predicted_prob = float(p)
-                    session.add(lead)
+            # one executemany UPDATE by primary key instead of a SELECT + UPDATE per lead
+            session.bulk_update_mappings(Lead, [
+                {"id": int(lid), "predicted_prob": float(p)} for lid, p in zip(df["id"], probs)
+            ])
             session.commit()
+            # also reached from the retrain daemon, which has no UI handler to do this
+            invalidate_leads_cache()
         except Exception:
             pass
         return pipeline
@@ -359,14 +518,24 @@ except Exception:
 # ---------------------------
 # SLA alert system (UI placeholders + badge + modal)
 # ---------------------------
-def count_overdue_leads(session, start_date=None, end_date=None):
-    df = leads_df(session, start_date, end_date)
-    cnt = 0
-    for _, row in df.iterrows():
-        _, overdue = calculate_remaining_sla(row.get("sla_entered_at"), row.get("sla_hours"))
-        if overdue and row.get("status") not in (LeadStatus.AWARDED, LeadStatus.LOST):
-            cnt += 1
-    return cnt
+def lead_status_counts(session, start_date=None, end_date=None):
+    # GROUP BY in SQLite: one row per status instead of one per lead
+    q = session.query(Lead.status, func.count(Lead.id)).group_by(Lead.status)
+    bounds = _created_bounds(start_date, end_date)
+    if bounds is not None:
+        q = q.filter(Lead.created_at >= bounds[0].to_pydatetime(), Lead.created_at < bounds[1].to_pydatetime())
+    return dict(q.all())
+
+def count_overdue_leads(session, start_date=None, end_date=None, now=None):
+    # a single COUNT against the stored, indexed deadline; no lead rows leave SQLite
+    q = session.query(func.count(Lead.id)).filter(
+        Lead.status.notin_([LeadStatus.AWARDED, LeadStatus.LOST]),
+        Lead.sla_deadline <= (now or datetime.utcnow()),
+    )
+    bounds = _created_bounds(start_date, end_date)
+    if bounds is not None:
+        q = q.filter(Lead.created_at >= bounds[0].to_pydatetime(), Lead.created_at < bounds[1].to_pydatetime())
+    return int(q.scalar() or 0)
 
 # background SLA notifier (prints / placeholder)
 def sla_background_worker(interval_sec=300):
@@ -396,8 +565,7 @@ except Exception:
 # ---------------------------
 st.set_page_config(page_title="Project X — Restoration Pipeline", layout="wide", initial_sidebar_state="expanded")
 APP_CSS = """
-@import url('https://fonts.googleapis.com/css2?family=Comfortaa:wght@300;400;700&display=swap');
-body, .stApp { font-family: 'Comfortaa', cursive; background:#0b1220; color:#fff; }
+body, .stApp { font-family: system-ui, -apple-system, "Segoe UI", Roboto, sans-serif; background:#0b1220; color:#fff; }
 .header { font-size:20px; font-weight:700; padding:8px 0; color:#fff; }
 .metric-card { border-radius:12px; padding:14px; margin:8px; color:#fff; background:#000; box-shadow:0 10px 20px rgba(0,0,0,0.4); }
 .kpi-title { color:#fff; font-weight:700; font-size:13px; }
@@ -412,7 +580,39 @@ body, .stApp { font-family: 'Comfortaa', cursive; background:#0b1220; color:#fff
   .metric-card { width:100% !important; }
 }
 """
-st.markdown(f"<style>{APP_CSS}</style>", unsafe_allow_html=True)
+
+# Streamlit clears every element that a rerun does not emit again, so the <style>
+# block itself still has to be sent on each run.
+APP_STYLE_HTML = f"<style>{APP_CSS}</style>"
+
+st.markdown(APP_STYLE_HTML, unsafe_allow_html=True)
+
+# KPI card markup, kept on one line so several cards can share one markdown call
+KPI_CARD_HTML = (
+    "<div class='metric-card' style='width:{width}%; min-width:200px;'>"
+    "<div class='kpi-title'>{title}</div>"
+    "<div class='kpi-value' style='color:{color};'>{value}</div>"
+    "<div class='small-muted'>{note}</div>"
+    "<div class='progress-wrap'><div class='progress-fill' style='width:{pct:.1f}%; background:{bar};'></div></div>"
+    "</div>"
+).format
+
+PRIORITY_CARD_HTML = (
+    "<div style='background:#000; padding:10px; border-radius:10px; margin-bottom:8px;'>"
+    "{label} #{id} — {name} — ${value:,.0f}{prob}{overdue}"
+    "</div>"
+).format
+PROB_BADGE_HTML = "<span style='color:{color}; font-weight:700; margin-left:8px;'>📊 {pct:.0f}%</span>".format
+SLA_OVERDUE_HTML = "<div style='color:#ef4444; font-weight:700;'>❗ OVERDUE</div>"
+SLA_LEFT_HTML = "<div style='color:#ef4444; font-weight:700;'>⏳ {hrs}h {mins}m</div>".format
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def stage_donut(counts):
+    # one Plotly build per distinct per-stage count tuple (LeadStatus.ALL order)
+    pie_df = pd.DataFrame({"status": LeadStatus.ALL, "count": list(counts)})
+    fig = px.pie(pie_df, names="status", values="count", hole=0.45, color="status", color_discrete_map=STAGE_COLORS)
+    fig.update_traces(textposition='inside', textinfo='percent+label')
+    return fig
 
 # ---------------------------
 # Sidebar controls (pages, quick add, retrain)
@@ -423,7 +623,7 @@ with st.sidebar:
     st.markdown("---")
     st.markdown("Quick Add Demo Lead")
     if st.button("Add Demo Lead"):
-        s = get_session()
+        created = datetime.utcnow()
         demo = Lead(
             source="Google Ads",
             source_details="gclid=demo",
@@ -438,41 +638,37 @@ with st.sidebar:
             sla_hours=24,
             cost_to_acquire=45.0,
             qualified=True,
-            created_at=datetime.utcnow()
+            created_at=created,
+            sla_entered_at=created,
         )
-        s.add(demo)
-        s.commit()
-        s.close()
+        with get_session() as s:
+            s.add(demo)
+            s.commit()
         st.success("Demo lead added.")
     st.markdown("---")
     st.markdown("Model (internal-only)")
     st.write("ML auto-trains in the background when enough labeled data exists.")
     if st.button("Force internal train now"):
-        s = get_session()
-        try:
-            res = auto_train_model(s)
-            if res:
-                st.success("Internal train complete.")
-            else:
-                st.warning("Training not completed (not enough labeled data?)")
-        except Exception as e:
-            st.error(f"Error training: {e}")
-        finally:
-            s.close()
+        with get_session() as s:
+            try:
+                res = auto_train_model(s)
+                if res:
+                    st.success("Internal train complete.")
+                else:
+                    st.warning("Training not completed (not enough labeled data?)")
+            except Exception as e:
+                st.error(f"Error training: {e}")
 
 # ---------------------------
 # Top header with bell badge and modal trigger
 # ---------------------------
-st.markdown("<div style='display:flex; justify-content:space-between; align-items:center;'>", unsafe_allow_html=True)
-st.markdown("<div class='header'>Project X — Sales & Conversion Tracker</div>", unsafe_allow_html=True)
-
-# compute badge count
-sess = get_session()
+# one clock snapshot per rerun, shared by the badge and every page below
+now = datetime.utcnow()
 today = date.today()
 # top-right date filter defaults to Today
 # We'll put UI later — compute overdue globally for badge
-badge_overdue = count_overdue_leads(sess)
-sess.close()
+with get_session() as sess:
+    badge_overdue = count_overdue_leads(sess, now=now)
 
 # Notification bell element (click toggles modal)
 if "show_sla_modal" not in st.session_state:
@@ -483,17 +679,19 @@ if "toasts" not in st.session_state:
 def toggle_sla_modal():
     st.session_state.show_sla_modal = not st.session_state.show_sla_modal
 
-# render bell
-bell_html = f"""
-<div style='display:flex; align-items:center;'>
-  <div class='bell' onclick="window.scrollTo(0,0)">
-    🔔 Alerts
-    <span style='margin-left:8px; font-size:13px; color:#9ca3af;'>{badge_overdue} overdue</span>
+# render title + bell in one element; split across calls the flex wrapper closed before its children
+header_html = f"""
+<div style='display:flex; justify-content:space-between; align-items:center;'>
+  <div class='header'>Project X — Sales & Conversion Tracker</div>
+  <div style='display:flex; align-items:center;'>
+    <div class='bell' onclick="window.scrollTo(0,0)">
+      🔔 Alerts
+      <span style='margin-left:8px; font-size:13px; color:#9ca3af;'>{badge_overdue} overdue</span>
+    </div>
   </div>
 </div>
 """
-st.markdown(bell_html, unsafe_allow_html=True)
-st.markdown("</div>", unsafe_allow_html=True)
+st.markdown(header_html, unsafe_allow_html=True)
 
 # ---------------------------
 # Pages
@@ -505,6 +703,13 @@ def show_toast(msg, kind="info"):
     # keep only last 5
     st.session_state.toasts = st.session_state.toasts[:5]
 
+# All Leads table selection: the widget reports row positions, which shift whenever the
+# list changes, so the lead id is captured against the ids the user was looking at
+def select_lead_row():
+    rows = st.session_state.all_leads_table.selection.rows
+    ids = st.session_state.get("all_leads_ids", [])
+    st.session_state.selected_lead_id = ids[rows[0]] if rows and rows[0] < len(ids) else None
+
 # display toasts area
 if st.session_state.toasts:
     for msg, kind in st.session_state.toasts[:4]:
@@ -546,31 +751,32 @@ if page == "Leads / Capture":
         cost_to_acquire = st.number_input("Cost to acquire lead ($)", min_value=0.0, value=0.0, step=1.0)
         submitted = st.form_submit_button("Create Lead")
         if submitted:
-            s = get_session()
-            try:
-                lead = Lead(
-                    source=source, source_details=source_details,
-                    contact_name=contact_name, contact_phone=contact_phone, contact_email=contact_email,
-                    property_address=property_address, damage_type=damage_type, assigned_to=assigned_to,
-                    notes=notes, estimated_value=float(estimated_value or 0.0),
-                    status=LeadStatus.NEW, created_at=datetime.utcnow(),
-                    sla_hours=int(sla_hours), sla_entered_at=datetime.utcnow(),
-                    qualified=True if qualified_choice == "Yes" else False,
-                    cost_to_acquire=float(cost_to_acquire or 0.0)
-                )
-                s.add(lead); s.commit(); s.refresh(lead)
-                show_toast(f"Lead created (ID: {lead.id})", "success")
-            except Exception as e:
-                st.error(f"Failed to create lead: {e}")
-                st.write(traceback.format_exc())
-            finally:
-                s.close()
+            with get_session() as s:
+                try:
+                    created = datetime.utcnow()
+                    lead = Lead(
+                        source=source, source_details=source_details,
+                        contact_name=contact_name, contact_phone=contact_phone, contact_email=contact_email,
+                        property_address=property_address, damage_type=damage_type, assigned_to=assigned_to,
+                        notes=notes, estimated_value=float(estimated_value or 0.0),
+                        status=LeadStatus.NEW, created_at=created, sla_entered_at=created,
+                        sla_hours=int(sla_hours),
+                        qualified=True if qualified_choice == "Yes" else False,
+                        cost_to_acquire=float(cost_to_acquire or 0.0)
+                    )
+                    # flush assigns the id inside the transaction; no refresh SELECT after commit
+                    s.add(lead); s.flush()
+                    lead_id = lead.id
+                    s.commit()
+                    show_toast(f"Lead created (ID: {lead_id})", "success")
+                except Exception as e:
+                    # full traceback goes to the server log, not the browser
+                    log.exception("lead create failed")
+                    st.error(f"Failed to create lead: {e}")
 
     st.markdown("---")
     # quick filters + search
-    s = get_session()
-    df = leads_df(s)
-    s.close()
+    df = cached_leads_df()
     if df.empty:
         st.info("No leads yet. Create one above.")
     else:
@@ -587,13 +793,11 @@ if page == "Leads / Capture":
         if q_source and q_source != "All":
             df_view = df_view[df_view["source"] == q_source]
         if q_text:
-            q2 = q_text.lower()
-            df_view = df_view[
-                df_view["contact_name"].fillna("").str.lower().str.contains(q2) |
-                df_view["contact_phone"].fillna("").str.lower().str.contains(q2) |
-                df_view["contact_email"].fillna("").str.lower().str.contains(q2) |
-                df_view["property_address"].fillna("").str.lower().str.contains(q2)
-            ]
+            # literal, case-insensitive match: no lower() copies, and "+1 555" is not a regex
+            hit = np.zeros(len(df_view), dtype=bool)
+            for c in ("contact_name", "contact_phone", "contact_email", "property_address"):
+                hit |= df_view[c].str.contains(q_text, case=False, regex=False, na=False).to_numpy(dtype=bool)
+            df_view = df_view[hit]
         st.dataframe(df_view.sort_values("created_at", ascending=False).head(200))
 
 # ---------------------------
@@ -608,54 +812,53 @@ elif page == "Pipeline Board":
     with col_right:
         quick_range = st.selectbox("Quick range", ["Today", "Yesterday", "Last 7 days", "Last 30 days", "All", "Custom"], index=0)
         if quick_range == "Today":
-            sdt = date.today(); edt = date.today()
+            sdt = today; edt = today
         elif quick_range == "Yesterday":
-            sdt = date.today() - timedelta(days=1); edt = sdt
+            sdt = today - timedelta(days=1); edt = sdt
         elif quick_range == "Last 7 days":
-            sdt = date.today() - timedelta(days=7); edt = date.today()
+            sdt = today - timedelta(days=7); edt = today
         elif quick_range == "Last 30 days":
-            sdt = date.today() - timedelta(days=30); edt = date.today()
+            sdt = today - timedelta(days=30); edt = today
         elif quick_range == "All":
-            s2 = get_session(); df_all = leads_df(s2, None, None); s2.close()
+            df_all = cached_leads_df(None, None)
             if df_all.empty:
-                sdt = date.today(); edt = date.today()
+                sdt = today; edt = today
             else:
                 sdt = df_all["created_at"].min().date(); edt = df_all["created_at"].max().date()
         else:
-            custom = st.date_input("Start, End", [date.today(), date.today()])
+            custom = st.date_input("Start, End", [today, today])
             if isinstance(custom, (list, tuple)) and len(custom) == 2:
                 sdt, edt = custom[0], custom[1]
             else:
-                sdt = date.today(); edt = date.today()
+                sdt = today; edt = today
 
-    s = get_session()
-    df = leads_df(s, sdt, edt)
-    s.close()
+    df = cached_leads_df(sdt, edt)
 
     total_leads = len(df)
-    qualified_leads = int(df[df["qualified"] == True].shape[0]) if not df.empty else 0
-    sla_success_count = int(df[df["contacted"] == True].shape[0]) if not df.empty else 0
+    # flag columns are plain bool dtype, so a sum counts them without building a filtered frame
+    qualified_leads = int(df["qualified"].sum())
+    sla_success_count = int(df["contacted"].sum())
     sla_success_pct = (sla_success_count / total_leads * 100) if total_leads else 0.0
     qualification_pct = (qualified_leads / total_leads * 100) if total_leads else 0.0
 
+    # one pass over the status column serves every status-based KPI and the donut below
+    status_counts = stage_counts(df["status"])
+    awarded_count = int(status_counts.get(LeadStatus.AWARDED, 0))
+    lost_count = int(status_counts.get(LeadStatus.LOST, 0))
+
     # conversion count counts both awarded and estimate_submitted/approved
-    awarded_count = int(df[df["status"] == LeadStatus.AWARDED].shape[0]) if not df.empty else 0
-    estimate_submitted_count = int(df[df["estimate_submitted"] == True].shape[0]) if not df.empty else 0
-    estimate_approved_count = int(df[df["estimate_approved"] == True].shape[0]) if not df.empty else 0
-    conversion_set = set()
-    if not df.empty:
-        if "id" in df.columns:
-            conversion_set.update(df[df["status"] == LeadStatus.AWARDED]["id"].tolist())
-            conversion_set.update(df[df["estimate_submitted"] == True]["id"].tolist())
-            conversion_set.update(df[df["estimate_approved"] == True]["id"].tolist())
-    conversion_count = len(conversion_set)
-    closed = awarded_count + int(df[df["status"] == LeadStatus.LOST].shape[0]) if not df.empty else 0
+    estimate_submitted_count = int(df["estimate_submitted"].sum())
+    estimate_approved_count = int(df["estimate_approved"].sum())
+    # ids are unique, so OR-ing the masks counts the same leads as the old id set union
+    conversion_mask = (df["status"] == LeadStatus.AWARDED) | df["estimate_submitted"].astype(bool) | df["estimate_approved"].astype(bool)
+    conversion_count = int(conversion_mask.sum())
+    closed = awarded_count + lost_count
     conversion_rate = (awarded_count / closed * 100) if closed else (conversion_count / total_leads * 100 if total_leads else 0.0)
-    inspection_scheduled_count = int(df[df["inspection_scheduled"] == True].shape[0]) if not df.empty else 0
+    inspection_scheduled_count = int(df["inspection_scheduled"].sum())
     inspection_pct = (inspection_scheduled_count / qualified_leads * 100) if qualified_leads else 0.0
-    estimate_sent_count = int(df[df["estimate_submitted"] == True].shape[0]) if not df.empty else 0
+    estimate_sent_count = estimate_submitted_count
     pipeline_job_value = float(df["estimated_value"].sum()) if not df.empty else 0.0
-    active_leads = total_leads - (awarded_count + int(df[df["status"] == LeadStatus.LOST].shape[0])) if not df.empty else 0
+    active_leads = total_leads - closed
 
     KPI_ITEMS = [
         ("Active Leads", f"{active_leads}", "Leads currently in pipeline"),
@@ -670,8 +873,8 @@ elif page == "Pipeline Board":
     num_colors = ["#3B82F6", "#ef4444", "#A78BFA", "#F97316", "#06B6D4", "#7C3AED", "#10B981"]
     bar_colors = ["#60A5FA", "#F87171", "#C4B5FD", "#FB923C", "#67E8F9", "#A78BFA", "#34D399"]
 
-    # render row 1 (4 cards)
-    st.markdown("<div style='display:flex; flex-wrap:wrap; gap:8px; align-items:stretch;'>", unsafe_allow_html=True)
+    # all KPI cards are collected and emitted with a single markdown call
+    kpi_html = ["<div style='display:flex; flex-wrap:wrap; gap:8px; align-items:stretch;'>"]
     for i in range(4):
         title, value, note = KPI_ITEMS[i]
         color = num_colors[i]
@@ -687,18 +890,11 @@ elif page == "Pipeline Board":
             pct = conversion_rate
         else:
             pct = 0
-        st.markdown(f"""
-            <div class='metric-card' style='width:24%; min-width:200px;'>
-                <div class='kpi-title'>{title}</div>
-                <div class='kpi-value' style='color:{color};'>{value}</div>
-                <div class='small-muted'>{note}</div>
-                <div class='progress-wrap'><div class='progress-fill' style='width:{pct:.1f}%; background:{bar};'></div></div>
-            </div>
-        """, unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
+        kpi_html.append(KPI_CARD_HTML(width=24, title=title, value=value, note=note, color=color, bar=bar, pct=pct))
+    kpi_html.append("</div>")
 
     # row 2 (3 cards)
-    st.markdown("<div style='display:flex; flex-wrap:wrap; gap:8px; margin-top:6px;'>", unsafe_allow_html=True)
+    kpi_html.append("<div style='display:flex; flex-wrap:wrap; gap:8px; margin-top:6px;'>")
     for i in range(4, 7):
         title, value, note = KPI_ITEMS[i]
         color = num_colors[i]
@@ -710,29 +906,20 @@ elif page == "Pipeline Board":
             pct = min(100, (pipeline_job_value / max(1.0, baseline)) * 100)
         else:
             pct = 0
-        st.markdown(f"""
-            <div class='metric-card' style='width:31%; min-width:200px;'>
-                <div class='kpi-title'>{title}</div>
-                <div class='kpi-value' style='color:{color};'>{value}</div>
-                <div class='small-muted'>{note}</div>
-                <div class='progress-wrap'><div class='progress-fill' style='width:{pct:.1f}%; background:{bar};'></div></div>
-            </div>
-        """, unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
+        kpi_html.append(KPI_CARD_HTML(width=31, title=title, value=value, note=note, color=color, bar=bar, pct=pct))
+    kpi_html.append("</div>")
+    st.markdown("".join(kpi_html), unsafe_allow_html=True)
     st.markdown("---")
 
     # Pipeline Stages donut
     st.markdown("### Lead Pipeline Stages")
     st.markdown("<em>Distribution of leads across pipeline stages. Use the date selector above to narrow the period.</em>", unsafe_allow_html=True)
-    stage_counts = df["status"].value_counts().reindex(LeadStatus.ALL, fill_value=0)
-    pie_df = pd.DataFrame({"status": stage_counts.index, "count": stage_counts.values})
+    pie_df = pd.DataFrame({"status": status_counts.index, "count": status_counts.values})
     if pie_df["count"].sum() == 0:
         st.info("No leads in selected range.")
     else:
         if px:
-            fig = px.pie(pie_df, names="status", values="count", hole=0.45, color="status", color_discrete_map=STAGE_COLORS)
-            fig.update_traces(textposition='inside', textinfo='percent+label')
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(stage_donut(tuple(status_counts.tolist())), use_container_width=True)
         else:
             st.table(pie_df)
 
@@ -740,46 +927,52 @@ elif page == "Pipeline Board":
     # TOP 5 PRIORITY LEADS
     st.markdown("### TOP 5 PRIORITY LEADS")
     st.markdown("<em>Highest urgency leads by priority score (0–1). Address these first.</em>", unsafe_allow_html=True)
-    pr_list = []
-    w = st.session_state.get("weights", {"value_weight":0.5,"sla_weight":0.35,"urgency_weight":0.15,"contacted_w":0.6,"inspection_w":0.5,"estimate_w":0.5,"value_baseline":5000.0})
-    for _, row in df.iterrows():
-        try:
-            score = compute_priority_for_lead_row(row, w)
-        except Exception:
-            score = 0.0
-        sla_sec, overdue = calculate_remaining_sla(row.get("sla_entered_at") or row.get("created_at"), row.get("sla_hours"))
-        pr_list.append({
-            "id": int(row["id"]),
-            "name": row.get("contact_name") or "No name",
-            "value": float(row.get("estimated_value") or 0.0),
-            "score": score,
-            "status": row.get("status"),
-            "overdue": overdue,
-            "prob": row.get("predicted_prob")
-        })
-    pr_df = pd.DataFrame(pr_list).sort_values("score", ascending=False)
-    if pr_df.empty:
+    top = cached_top_priority(sdt, edt, st.session_state.get("weights", DEFAULT_PRIORITY_WEIGHTS))
+    if top.empty:
         st.info("No priority leads")
     else:
-        for _, r in pr_df.head(5).iterrows():
-            label = "🔴 CRITICAL" if r["score"] >= 0.7 else ("🟠 HIGH" if r["score"] >= 0.45 else "🟢 NORMAL")
+        cards_html = []
+        top = top.assign(
+            contact_name=top["contact_name"].fillna("").replace("", "No name"),
+            label_html=priority_label_html(top["priority_score"]),
+        )
+        for r in top.itertuples(index=False, name="Lead"):
             prob_html = ""
-            if r.get("prob") is not None:
-                p = r["prob"] * 100
-                prob_color = "#22c55e" if p > 70 else ("#f97316" if p > 40 else "#ef4444")
-                prob_html = f"<span style='color:{prob_color}; font-weight:700; margin-left:8px;'>📊 {p:.0f}%</span>"
-            overdue_html = "<span style='color:#ef4444;'> ❗OVERDUE</span>" if r["overdue"] else ""
-            st.markdown(f"<div style='background:#000; padding:10px; border-radius:10px; margin-bottom:8px;'><b>{label}</b> #{r['id']} — {r['name']} — ${r['value']:,.0f}{prob_html}{overdue_html}</div>", unsafe_allow_html=True)
+            if pd.notna(r.predicted_prob):
+                p = r.predicted_prob * 100
+                prob_html = PROB_BADGE_HTML(color="#22c55e" if p > 70 else ("#f97316" if p > 40 else "#ef4444"), pct=p)
+            cards_html.append(PRIORITY_CARD_HTML(
+                label=r.label_html, id=r.id, name=r.contact_name, value=r.estimated_value,
+                prob=prob_html, overdue=OVERDUE_BADGE_HTML if r.overdue else "",
+            ))
+        st.markdown("".join(cards_html), unsafe_allow_html=True)
 
     st.markdown("---")
     # All leads expandable with edit
-    st.markdown("### 📋 All Leads (expand a card to edit / change status)")
-    st.markdown("<em>Expand a lead to edit details, change status, upload invoice when awarded, and create estimates.</em>", unsafe_allow_html=True)
-    s2 = get_session()
-    all_leads = s2.query(Lead).order_by(Lead.created_at.desc()).all()
-    for lead in all_leads:
+    st.markdown("### 📋 All Leads (select a row to edit / change status)")
+    st.markdown("<em>Select a lead to edit details, change status, upload invoice when awarded, and create estimates.</em>", unsafe_allow_html=True)
+    # every lead, not the default today-only window of cached_leads_df
+    all_df = _cached_leads_frame(leads_db_version())
+    lead = None
+    if all_df.empty:
+        st.info("No leads yet.")
+    else:
+        st.session_state.all_leads_ids = all_df["id"].tolist()
+        # one grid element for the whole list; only the selected lead gets a form
+        table = st.dataframe(
+            all_df[["id", "status", "contact_name", "damage_type", "estimated_value", "sla_deadline"]],
+            on_select=select_lead_row, selection_mode="single-row", key="all_leads_table",
+            hide_index=True, use_container_width=True,
+        )
+        selected_id = st.session_state.get("selected_lead_id")
+        if table.selection.rows and selected_id is not None:
+            with get_session() as s2:
+                lead = s2.get(Lead, int(selected_id))
+    # expire_on_commit only applies to commits, so the loaded lead stays readable after close
+    if lead is not None:
         title = f"#{lead.id} — {lead.contact_name or 'No name'} — {lead.damage_type or 'Unknown'} — ${lead.estimated_value or 0:.0f}"
-        with st.expander(title):
+        with st.container(border=True):
+            st.markdown(f"**{title}**")
             colA, colB = st.columns([3,1])
             with colA:
                 st.write(f"**Source:** {lead.source}  |  **Assigned:** {lead.assigned_to or '—'}")
@@ -787,22 +980,13 @@ elif page == "Pipeline Board":
                 st.write(f"**Notes:** {lead.notes or '—'}")
                 st.write(f"**Created:** {lead.created_at.strftime('%Y-%m-%d %H:%M') if lead.created_at else '—'}")
             with colB:
-                entered = lead.sla_entered_at or lead.created_at
-                if isinstance(entered, str):
-                    try:
-                        entered = datetime.fromisoformat(entered)
-                    except:
-                        entered = datetime.utcnow()
-                if entered is None:
-                    entered = datetime.utcnow()
-                deadline = entered + timedelta(hours=(lead.sla_hours or 24))
-                remaining = deadline - datetime.utcnow()
-                if remaining.total_seconds() <= 0:
-                    sla_html = "<div style='color:#ef4444; font-weight:700;'>❗ OVERDUE</div>"
+                # the insert trigger fills sla_deadline; the fallback only covers rows with no timestamps at all
+                deadline = lead.sla_deadline or sla_deadline_for(lead.sla_entered_at or lead.created_at or now, lead.sla_hours)
+                remaining_s = (deadline - now).total_seconds()
+                if remaining_s <= 0:
+                    sla_html = SLA_OVERDUE_HTML
                 else:
-                    hrs = int(remaining.total_seconds() // 3600)
-                    mins = int((remaining.total_seconds() % 3600) // 60)
-                    sla_html = f"<div style='color:#ef4444; font-weight:700;'>⏳ {hrs}h {mins}m</div>"
+                    sla_html = SLA_LEFT_HTML(hrs=int(remaining_s // 3600), mins=int((remaining_s % 3600) // 60))
                 st.markdown(sla_html, unsafe_allow_html=True)
             st.markdown("---")
             with st.form(f"update_lead_{lead.id}"):
@@ -824,36 +1008,54 @@ elif page == "Pipeline Board":
                 elif ns == LeadStatus.LOST:
                     lost_comment = st.text_area("Lost Comment", key=f"lost_comment_{lead.id}")
                 if st.form_submit_button("Save"):
-                    dbs = get_session()
-                    dblead = dbs.query(Lead).filter(Lead.id == lead.id).first()
-                    if dblead:
-                        dblead.status = ns
-                        dblead.assigned_to = na
-                        dblead.contacted = bool(nc)
-                        dblead.inspection_scheduled = bool(nsched)
-                        dblead.inspection_completed = bool(ncomp)
-                        dblead.estimate_submitted = bool(nsub)
-                        dblead.estimate_approved = bool(napp)
-                        dblead.notes = nnotes
-                        dblead.estimated_value = float(new_val or 0.0)
-                        if dblead.sla_entered_at is None:
-                            dblead.sla_entered_at = datetime.utcnow()
-                        if ns == LeadStatus.AWARDED:
-                            dblead.awarded_date = datetime.utcnow()
-                            dblead.awarded_comment = award_comment
-                            if awarded_invoice_file is not None:
-                                path = save_uploaded_file(awarded_invoice_file, prefix=f"lead_{dblead.id}_inv")
-                                dblead.awarded_invoice = path
-                        if ns == LeadStatus.LOST:
-                            dblead.lost_date = datetime.utcnow()
-                            dblead.lost_comment = lost_comment
-                        dbs.add(dblead)
-                        dbs.commit()
-                        dbs.close()
-                        show_toast(f"Lead #{dblead.id} updated", "success")
-                    else:
+                    saved_at = datetime.utcnow()
+                    invoice_path = None
+                    updates = {
+                        Lead.status: ns,
+                        Lead.assigned_to: na,
+                        Lead.contacted: bool(nc),
+                        Lead.inspection_scheduled: bool(nsched),
+                        Lead.inspection_completed: bool(ncomp),
+                        Lead.estimate_submitted: bool(nsub),
+                        Lead.estimate_approved: bool(napp),
+                        Lead.notes: nnotes,
+                        Lead.estimated_value: float(new_val or 0.0),
+                        # only stamps leads that never entered an SLA window, from the row itself
+                        # (same start as the deadline trigger), not the render-time snapshot
+                        Lead.sla_entered_at: func.coalesce(Lead.sla_entered_at, Lead.created_at, saved_at),
+                    }
+                    if ns == LeadStatus.AWARDED:
+                        updates[Lead.awarded_date] = saved_at
+                        updates[Lead.awarded_comment] = award_comment
+                        if awarded_invoice_file is not None:
+                            invoice_path = upload_path(awarded_invoice_file, prefix=f"lead_{lead.id}_inv")
+                            updates[Lead.awarded_invoice] = invoice_path
+                    if ns == LeadStatus.LOST:
+                        updates[Lead.lost_date] = saved_at
+                        updates[Lead.lost_comment] = lost_comment
+                    saved = False
+                    updated = 0
+                    try:
+                        # the invoice is on disk before the UPDATE opens a transaction, so the write
+                        # never holds the SQLite lock
+                        if invoice_path is not None:
+                            save_uploaded_file(awarded_invoice_file, path=invoice_path)
+                        # one UPDATE ... WHERE id = ?, no SELECT and no ORM dirty tracking
+                        with get_session() as dbs:
+                            updated = dbs.query(Lead).filter(Lead.id == lead.id).update(updates, synchronize_session=False)
+                            dbs.commit()
+                        saved = True
+                    except Exception as e:
+                        log.exception("lead %s save failed", lead.id)
+                        st.error(f"Failed to save lead: {e}")
+                    # nothing in the DB points at the file unless the UPDATE matched and committed
+                    if not (saved and updated) and invoice_path is not None and os.path.exists(invoice_path):
+                        os.remove(invoice_path)
+                    if saved and updated:
+                        invalidate_leads_cache()
+                        show_toast(f"Lead #{lead.id} updated", "success")
+                    elif saved:
                         st.error("Lead not found")
-    s2.close()
 
 # ---------------------------
 # Page: Analytics & SLA
@@ -861,11 +1063,9 @@ elif page == "Pipeline Board":
 elif page == "Analytics & SLA":
     st.header("📈 Analytics — SLA & Trends")
     st.markdown("<em>Select a date range and see trends for pipeline & SLA.</em>", unsafe_allow_html=True)
-    s = get_session()
-    df_all = leads_df(s, None, None)
+    df_all = cached_leads_df(None, None)
     if df_all.empty:
         st.info("No leads recorded yet.")
-        s.close()
     else:
         min_date = df_all["created_at"].min().date()
         max_date = df_all["created_at"].max().date()
@@ -873,17 +1073,15 @@ elif page == "Analytics & SLA":
         start_date = col1.date_input("Start date", min_value=min_date, value=min_date)
         end_date = col2.date_input("End date", min_value=start_date, value=max_date)
 
-        df_range = leads_df(s, start_date, end_date)
+        df_range = cached_leads_df(start_date, end_date)
         st.markdown("#### Pipeline Stages (donut)")
-        stage_counts = df_range["status"].value_counts().reindex(LeadStatus.ALL, fill_value=0)
-        pie_df = pd.DataFrame({"status": stage_counts.index, "count": stage_counts.values})
+        range_counts = stage_counts(df_range["status"])
+        pie_df = pd.DataFrame({"status": range_counts.index, "count": range_counts.values})
         if pie_df["count"].sum() == 0:
             st.info("No leads in selected range.")
         else:
             if px:
-                fig = px.pie(pie_df, names="status", values="count", hole=0.45, color="status", color_discrete_map=STAGE_COLORS)
-                fig.update_traces(textposition='inside', textinfo='percent+label')
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(stage_donut(tuple(range_counts.tolist())), use_container_width=True)
             else:
                 st.table(pie_df)
 
@@ -891,26 +1089,17 @@ elif page == "Analytics & SLA":
         st.subheader("SLA / Overdue Leads")
         st.markdown("<em>Trend of SLA overdue counts (last 30 days) and current overdue leads table.</em>", unsafe_allow_html=True)
 
-        today_dt = datetime.utcnow().date()
+        # stored deadlines serve both the trend and the overdue table below
+        deadline = df_range["sla_deadline"]
+        is_open = ~df_range["status"].isin([LeadStatus.AWARDED, LeadStatus.LOST])
+        today_dt = now.date()
         days_back = 30
-        ts_rows = []
-        for d in range(days_back, -1, -1):
-            day = today_dt - timedelta(days=d)
-            day_start = datetime.combine(day, datetime.min.time())
-            day_end = datetime.combine(day, datetime.max.time())
-            overdue_count = 0
-            for _, row in df_range.iterrows():
-                sla_entered = row.get("sla_entered_at") or row.get("created_at")
-                if isinstance(sla_entered, str):
-                    try:
-                        sla_entered = datetime.fromisoformat(sla_entered)
-                    except:
-                        sla_entered = row.get("created_at") or datetime.utcnow()
-                deadline = sla_entered + timedelta(hours=int(row.get("sla_hours") or 24))
-                if deadline <= day_end and row.get("status") not in (LeadStatus.AWARDED, LeadStatus.LOST):
-                    overdue_count += 1
-            ts_rows.append({"date": day, "overdue_count": overdue_count})
-        ts_df = pd.DataFrame(ts_rows)
+        days = [today_dt - timedelta(days=d) for d in range(days_back, -1, -1)]
+        day_ends = np.array([datetime.combine(day, datetime.max.time()) for day in days], dtype="datetime64[ns]")
+        # an open lead is overdue on every day ending at/after its deadline, so each day's
+        # count is a binary search into the sorted deadlines instead of a pass over the frame
+        open_deadlines = np.sort(deadline[is_open].dropna().to_numpy(dtype="datetime64[ns]"))
+        ts_df = pd.DataFrame({"date": days, "overdue_count": np.searchsorted(open_deadlines, day_ends, side="right")})
         if px:
             fig = px.line(ts_df, x="date", y="overdue_count", markers=True, labels={"overdue_count": "Overdue leads"})
             fig.update_layout(margin=dict(t=6,b=6))
@@ -919,24 +1108,14 @@ elif page == "Analytics & SLA":
             st.dataframe(ts_df)
 
         # overdue table current
-        overdue_rows = []
-        for _, row in df_range.iterrows():
-            sla_entered = row.get("sla_entered_at") or row.get("created_at")
-            if isinstance(sla_entered, str):
-                try:
-                    sla_entered = datetime.fromisoformat(sla_entered)
-                except:
-                    sla_entered = datetime.utcnow()
-            sla_hours = int(row.get("sla_hours") or 24)
-            deadline = sla_entered + timedelta(hours=sla_hours)
-            overdue = deadline < datetime.utcnow() and row.get("status") not in (LeadStatus.AWARDED, LeadStatus.LOST)
-            overdue_rows.append({"id": row.get("id"), "contact": row.get("contact_name"), "status": row.get("status"), "deadline": deadline, "overdue": overdue})
-        df_overdue = pd.DataFrame(overdue_rows)
+        df_overdue = pd.DataFrame({
+            "id": df_range["id"], "contact": df_range["contact_name"], "status": df_range["status"], "deadline": deadline,
+            "overdue": (deadline < pd.Timestamp(now)) & is_open,
+        })
         if not df_overdue.empty:
-            st.dataframe(df_overdue[df_overdue["overdue"] == True].sort_values("deadline"))
+            st.dataframe(df_overdue[df_overdue["overdue"]].sort_values("deadline"))
         else:
             st.success("No SLA overdue leads in this range 🎉")
-    s.close()
 
 # ---------------------------
 # Page: CPA & ROI
@@ -944,36 +1123,37 @@ elif page == "Analytics & SLA":
 elif page == "CPA & ROI":
     st.header("💰 CPA & ROI")
     st.markdown("<em>Total Marketing Spend vs Conversions. Default date range is Today.</em>", unsafe_allow_html=True)
-    s = get_session()
-    df_all = leads_df(s, None, None)
+    df_all = cached_leads_df(None, None)
     if df_all.empty:
         st.info("No leads yet.")
-        s.close()
     else:
         col1, col2 = st.columns(2)
-        start = col1.date_input("Start date", value=date.today())
-        end = col2.date_input("End date", value=date.today())
-        df_view = leads_df(s, start, end)
-        total_spend = float(df_view["cost_to_acquire"].fillna(0).sum()) if not df_view.empty else 0.0
-        conv_ids = set()
-        if not df_view.empty:
-            conv_ids.update(df_view[df_view["status"] == LeadStatus.AWARDED]["id"].tolist())
-            conv_ids.update(df_view[df_view["estimate_submitted"] == True]["id"].tolist())
-            if "estimate_approved" in df_view.columns:
-                conv_ids.update(df_view[df_view["estimate_approved"] == True]["id"].tolist())
-        conversions = len(conv_ids)
+        start = col1.date_input("Start date", value=today)
+        end = col2.date_input("End date", value=today)
+        df_view = cached_leads_df(start, end)
+        # spend (all leads) and revenue (awarded leads) come out of a single agg call
+        awarded_mask = df_view["status"] == LeadStatus.AWARDED
+        totals = (df_view[["cost_to_acquire"]]
+                  .assign(revenue=df_view["estimated_value"].where(awarded_mask, 0.0))
+                  .agg({"cost_to_acquire": "sum", "revenue": "sum"}))
+        total_spend = float(totals["cost_to_acquire"])
+        revenue = float(totals["revenue"])
+        # ids are unique, so OR-ing the masks counts the same leads as an id set union
+        conversions = int((awarded_mask | df_view["estimate_submitted"] | df_view["estimate_approved"]).sum())
         cpa = (total_spend / conversions) if conversions else 0.0
-        revenue = float(df_view[df_view["status"] == LeadStatus.AWARDED]["estimated_value"].fillna(0).sum()) if not df_view.empty else 0.0
         roi_value = revenue - total_spend
         roi_pct = (roi_value / total_spend * 100) if total_spend else 0.0
 
-        st.markdown(f"<div style='font-family:Comfortaa; font-size:16px;'>💰 Total Marketing Spend: <span style='color:#ef4444; font-weight:800;'>${total_spend:,.2f}</span></div>", unsafe_allow_html=True)
-        st.markdown(f"<div style='font-family:Comfortaa; font-size:16px;'>✅ Conversions (Won or Est Sent): <span style='color:#2563eb; font-weight:800;'>{conversions}</span></div>", unsafe_allow_html=True)
-        st.markdown(f"<div style='font-family:Comfortaa; font-size:16px;'>🎯 CPA: <span style='color:#f97316; font-weight:800;'>${cpa:,.2f}</span></div>", unsafe_allow_html=True)
-        st.markdown(f"<div style='font-family:Comfortaa; font-size:16px;'>📈 ROI: <span style='color:#22c55e; font-weight:800;'>${roi_value:,.2f} ({roi_pct:.1f}%)</span></div>", unsafe_allow_html=True)
+        st.markdown(
+            f"<div style='font-size:16px;'>💰 Total Marketing Spend: <span style='color:#ef4444; font-weight:800;'>${total_spend:,.2f}</span></div>"
+            f"<div style='font-size:16px;'>✅ Conversions (Won or Est Sent): <span style='color:#2563eb; font-weight:800;'>{conversions}</span></div>"
+            f"<div style='font-size:16px;'>🎯 CPA: <span style='color:#f97316; font-weight:800;'>${cpa:,.2f}</span></div>"
+            f"<div style='font-size:16px;'>📈 ROI: <span style='color:#22c55e; font-weight:800;'>${roi_value:,.2f} ({roi_pct:.1f}%)</span></div>",
+            unsafe_allow_html=True,
+        )
 
         if not df_view.empty and "created_at" in df_view.columns:
-            chart_df = pd.DataFrame({"date": df_view["created_at"].dt.date, "spend": df_view["cost_to_acquire"], "won": df_view["status"].apply(lambda s: 1 if s == LeadStatus.AWARDED else 0), "est_sent": df_view["estimate_submitted"].apply(lambda b: 1 if b else 0)})
+            chart_df = pd.DataFrame({"date": df_view["created_at"].dt.date, "spend": df_view["cost_to_acquire"], "won": awarded_mask.astype(int), "est_sent": df_view["estimate_submitted"].astype(int)})
             agg = chart_df.groupby("date").agg({"spend": "sum", "won": "sum", "est_sent": "sum"}).reset_index()
             agg["conversions"] = agg["won"] + agg["est_sent"]
             if px:
@@ -982,7 +1162,6 @@ elif page == "CPA & ROI":
                 st.plotly_chart(fig, use_container_width=True)
             else:
                 st.dataframe(agg)
-    s.close()
 
 # ---------------------------
 # Page: ML (internal)
@@ -993,14 +1172,15 @@ elif page == "ML (Internal)":
     if not SKLEARN_OK:
         st.error("scikit-learn or joblib not available — ML disabled.")
     else:
-        s = get_session()
-        df = leads_df(s, None, None)
-        labeled = df[df["status"].isin([LeadStatus.AWARDED, LeadStatus.LOST])]
-        st.write(f"Labeled leads (awarded/lost): {len(labeled)}")
+        df = cached_leads_df(None, None)
+        with get_session() as s:
+            counts = lead_status_counts(s)
+        st.write(f"Labeled leads (awarded/lost): {counts.get(LeadStatus.AWARDED, 0) + counts.get(LeadStatus.LOST, 0)}")
         st.write("Model file:", MODEL_FILE if os.path.exists(MODEL_FILE) else "No model persisted")
         if st.button("Force one-off internal train now"):
             try:
-                trained = auto_train_model(s)
+                with get_session() as s:
+                    trained = auto_train_model(s)
                 if trained:
                     st.success("Internal training completed and model saved.")
                 else:
@@ -1012,21 +1192,18 @@ elif page == "ML (Internal)":
         dfp["win_prob"] = dfp["predicted_prob"].fillna(0) * 100
         if not dfp.empty:
             st.dataframe(dfp.sort_values("win_prob", ascending=False)[["id", "contact_name", "status", "win_prob"]].head(200))
-        s.close()
 
 # ---------------------------
 # Page: Exports
 # ---------------------------
 elif page == "Exports":
     st.header("📤 Export data")
-    s = get_session()
-    df_leads = leads_df(s, None, None)
+    df_leads = cached_leads_df(None, None)
     if df_leads.empty:
         st.info("No leads to export.")
     else:
-        csv = df_leads.to_csv(index=False).encode("utf-8")
+        csv = cached_leads_csv(None, None)
         st.download_button("Download leads.csv", csv, file_name="leads.csv", mime="text/csv")
-    s.close()
 
 # ---------------------------
 # End of app